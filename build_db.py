@@ -1,17 +1,15 @@
 """Build DB script."""
 import argparse
-import asyncio
+import sqlite3
 
-import aiosqlite
+from simple_kp.build_db import add_data_sync
 
-from simple_kp.build_db import add_data
 
-
-async def main(filename, **kwargs):
+def main(filename, **kwargs):
     """Load data from CSV files."""
-    connection = await aiosqlite.connect(filename)
-    await add_data(connection, **kwargs)
-    await connection.close()
+    connection = sqlite3.connect(filename)
+    add_data_sync(connection, **kwargs)
+    connection.close()
 
 
 if __name__ == '__main__':
@@ -24,8 +22,8 @@ if __name__ == '__main__':
     parser.add_argument('--edges', type=str, default='', help='edges.csv')
 
     args = parser.parse_args()
-    asyncio.run(main(
+    main(
         args.filename,
         nodes_file=args.nodes,
         edges_file=args.edges,
-    ))
+    )
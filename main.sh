@@ -1,13 +1,24 @@
 #!/usr/bin/env bash
 
-while getopts 'n:e:' opt
+while getopts 'n:e:d:' opt
 do
   case $opt in
     n) NODES=$OPTARG ;;
     e) EDGES=$OPTARG ;;
+    d) DATABASE=$OPTARG ;;
   esac
 done
 
-python build_db.py data.db --nodes $NODES --edges $EDGES
+# use a prebuilt database (from build_db.py) if given, skipping the CSV load
+if [ -n "$DATABASE" ]; then
+  # data.db is deleted on exit, so it must be a copy
+  if [ "$DATABASE" -ef data.db ]; then
+    echo "Database must not be ./data.db, which is removed on exit" >&2
+    exit 1
+  fi
+  cp "$DATABASE" data.db || exit 1
+else
+  python build_db.py data.db --nodes $NODES --edges $EDGES
+fi
 uvicorn simple_kp.server:app --host 0.0.0.0 --port 5139 --reload
 rm data.db
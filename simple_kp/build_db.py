@@ -1,16 +1,77 @@
 #!/usr/bin/env python
 """Data I/O."""
 import csv
+import itertools
+import json
+import operator
 import re
+import sqlite3
 import uuid
 
 import aiosqlite
 
 from small_kg import mychem, synonyms_file
 from ._types import CURIEMap
+from .util import MAX_VARIABLES
 
+BULK_LOAD_PRAGMAS = [
+    # only takes effect on a new database, so must come first
+    "PRAGMA page_size=8192",
+    # the journal is left in its default, crash-safe mode: loads may add to
+    # an existing file, and it does little work for a new one anyway
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+]
+BATCH_SIZE = 10000
+# (name, columns) of the indexes to build on each table, where it has all
+# of the columns; the edges index covers get_kedges' projection, and edges
+# are only ever looked up by source, with reverse traversals stored as
+# "<-p-" rows
+INDEXES = {
+    "nodes": [
+        ("idx_nodes_id", ["id"]),
+    ],
+    "edges": [
+        ("idx_edges_src_pred", ["source", "predicate", "target", "id"]),
+    ],
+}
 
-async def get_data_from_string(data: str):
+# (source category, predicate, target category) for every edge, with the
+# JSON-encoded node categories expanded by json_each()
+BUILD_OPERATIONS = """
+CREATE TABLE operations AS
+SELECT DISTINCT
+    source_category.value AS source_type,
+    edges.predicate AS edge_type,
+    target_category.value AS target_type
+FROM edges
+JOIN nodes AS source ON source.id = edges.source
+JOIN json_each(source.category) AS source_category
+JOIN nodes AS target ON target.id = edges.target
+JOIN json_each(target.category) AS target_category
+"""
+
+# database format, kept in PRAGMA user_version:
+# 0 - node categories stored as "|a||b|", no operations table
+# 1 - node categories stored as JSON arrays, operations table
+FORMAT_VERSION = 1
+# node categories as stored by format 0
+OLD_CATEGORY_PATTERN = re.compile(r"\|(.*?)\|")
+
+NODE_PATTERN = re.compile(
+    r"(?P<id>[\w:]+)"
+    r"\(\( category (?P<category>[\w:]+) \)\)",
+    re.ASCII,
+)
+EDGE_PATTERN = re.compile(
+    r"(?P<source>[\w:]+)"
+    r"(?P<o2s><?)-- predicate (?P<predicate>[\w:]+) --(?P<s2o>>?)"
+    r"(?P<target>[\w:]+)",
+    re.ASCII,
+)
+
+
+def get_data_from_string(data: str):
     """Get data from string.
 
     Each line should be of the form:
@@ -18,15 +79,6 @@ async def get_data_from_string(data: str):
     or
     <CURIE>-- predicate <predicate> --><CURIE>
     """
-    node_pattern = (
-        r"(?P<id>[\w:]+)"
-        r"\(\( category (?P<category>[\w:]+) \)\)"
-    )
-    edge_pattern = (
-        r"(?P<source>[\w:]+)"
-        r"(?P<o2s><?)-- predicate (?P<predicate>[\w:]+) --(?P<s2o>>?)"
-        r"(?P<target>[\w:]+)"
-    )
     nodes = {}
     edges = {}
     for line in data.split("\n"):
@@ -34,7 +86,7 @@ async def get_data_from_string(data: str):
         if not line:
             continue
 
-        match = re.fullmatch(node_pattern, line)
+        match = NODE_PATTERN.fullmatch(line)
         if match is not None:
             nid = match.group("id")
             if nid not in nodes:
@@ -48,7 +100,7 @@ async def get_data_from_string(data: str):
             )
             continue
 
-        match = re.fullmatch(edge_pattern, line)
+        match = EDGE_PATTERN.fullmatch(line)
         if match is not None:
             eid = str(uuid.uuid4())
 
@@ -70,65 +122,316 @@ async def get_data_from_string(data: str):
     return list(nodes.values()), list(edges.values())
 
 
-async def get_data_from_files(
+def read_csv(filename):
+    """Stream rows from CSV file, starting with the header.
+
+    Blank lines are skipped, as by csv.DictReader; every other row must
+    have a field for each column.
+    """
+    with open(filename, newline="", encoding="utf-8-sig") as csvfile:
+        reader = csv.reader(
+            csvfile,
+            delimiter=',',
+        )
+        header = next(reader, None)
+        if header is None:
+            return
+        yield header
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != len(header):
+                raise ValueError(
+                    "{0}, line {1}: expected {2} fields, got {3}".format(
+                        filename,
+                        reader.line_num,
+                        len(header),
+                        len(row),
+                    )
+                )
+            yield row
+
+
+def encode_list(values):
+    """Encode list as a JSON array."""
+    return json.dumps(values, separators=(",", ":"))
+
+
+def batched(iterable, size=BATCH_SIZE):
+    """Yield lists of up to `size` items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def row_getter(columns):
+    """Get function returning a record's values for columns, as a tuple."""
+    if not columns:
+        return lambda record: ()
+    getter = operator.itemgetter(*columns)
+    if len(columns) == 1:
+        return lambda record: (getter(record),)
+    return getter
+
+
+def to_table(records):
+    """Convert list of dicts to header and rows."""
+    if not records:
+        return [], []
+    header = list(records[0])
+    return header, map(row_getter(header), records)
+
+
+def get_data_from_files(
         curie_prefixes: CURIEMap = None,
         nodes_file=mychem.nodes_file,
         edges_file=mychem.edges_file,
 ):
-    """Get data from files."""
-    with open(nodes_file, newline="", encoding="utf-8-sig") as csvfile:
-        reader = csv.DictReader(
-            csvfile,
-            delimiter=',',
+    """Get data from files.
+
+    Returns a (header, rows) pair for each of nodes and edges. Unless
+    CURIEs must be re-mapped, rows are streamed straight from the files.
+    """
+    if curie_prefixes is not None:
+        return get_remapped_data_from_files(
+            curie_prefixes,
+            nodes_file,
+            edges_file,
+        )
+
+    nodes = read_csv(nodes_file)
+    node_header = next(nodes, [])
+    if "category" in node_header:
+        category_idx = node_header.index("category")
+        nodes = (
+            [
+                *row[:category_idx],
+                encode_list([row[category_idx]]),
+                *row[category_idx + 1:],
+            ]
+            for row in nodes
+        )
+
+    edges = read_csv(edges_file)
+    edge_header = next(edges, [])
+    if "id" in edge_header:
+        # number the edges in place of any ids they have
+        id_idx = edge_header.index("id")
+        edges = (
+            [*row[:id_idx], idx, *row[id_idx + 1:]]
+            for idx, row in enumerate(edges)
         )
-        nodes = list(reader)
-    with open(edges_file, newline="", encoding="utf-8-sig") as csvfile:
-        reader = csv.DictReader(
+    else:
+        edge_header = edge_header + ["id"]
+        edges = (
+            [*row, idx]
+            for idx, row in enumerate(edges)
+        )
+    return (node_header, nodes), (edge_header, edges)
+
+
+def get_remapped_data_from_files(
+        curie_prefixes: CURIEMap,
+        nodes_file,
+        edges_file,
+):
+    """Get data from files, mapping CURIEs to preferred prefixes.
+
+    The node map is filled in as node rows are streamed, so the edge rows
+    must be consumed after the node rows.
+    """
+    # map to synonyms with prefix
+    # term -> {prefix: CURIE} for the term's synset
+    synset_map = dict()
+    with open(synonyms_file, newline="") as csvfile:
+        reader = csv.reader(
             csvfile,
             delimiter=',',
         )
-        edges = list(reader)
-    edges = [
-        {
-            **edge,
-            "id": idx
-        }
-        for idx, edge in enumerate(edges)
-    ]
+        for synset in reader:
+            by_prefix = dict()
+            for curie in synset:
+                by_prefix.setdefault(curie.split(":", 1)[0], curie)
+            for term in synset:
+                synset_map[term] = by_prefix
+    node_map = dict()
 
-    if curie_prefixes is not None:
-        # map to synonyms with prefix
-        with open(synonyms_file, newline="") as csvfile:
-            reader = csv.reader(
-                csvfile,
-                delimiter=',',
-            )
-            synsets = list(reader)
-        synset_map = {
-            term: synset
-            for synset in synsets
-            for term in synset
-        }
-        node_map = dict()
-        for node in nodes:
+    nodes = read_csv(nodes_file)
+    node_header = next(nodes, [])
+    node_col = {name: idx for idx, name in enumerate(node_header)}
+
+    def remap_nodes():
+        """Map node ids to preferred CURIEs."""
+        id_idx, category_idx = node_col["id"], node_col["category"]
+        for row in nodes:
+            by_prefix = synset_map.get(row[id_idx], {})
             # get preferred CURIE
-            for curie_prefix in curie_prefixes[node["category"]]:
+            for curie_prefix in curie_prefixes[row[category_idx]]:
                 # get CURIE with prefix, if one exists
-                try:
-                    node_map[node["id"]] = next(
-                        curie
-                        for curie in synset_map[node["id"]]
-                        if curie.startswith(curie_prefix + ":")
-                    )
+                if curie_prefix in by_prefix:
+                    node_map[row[id_idx]] = by_prefix[curie_prefix]
+                    row[id_idx] = by_prefix[curie_prefix]
                     break
-                except StopIteration:
-                    continue
+            row[category_idx] = encode_list([row[category_idx]])
+            yield row
+
+    edges = read_csv(edges_file)
+    edge_header = next(edges, [])
+    edge_col = {name: idx for idx, name in enumerate(edge_header)}
+    if "id" not in edge_col:
+        edge_header = edge_header + ["id"]
+
+    def remap_edges():
+        """Map edge endpoints to preferred CURIEs."""
+        subject_idx, object_idx = edge_col["subject"], edge_col["object"]
+        id_idx = edge_col.get("id")
+        for idx, row in enumerate(edges):
+            row[subject_idx] = node_map.get(row[subject_idx], row[subject_idx])
+            row[object_idx] = node_map.get(row[object_idx], row[object_idx])
+            if id_idx is None:
+                row.append(idx)
+            else:
+                row[id_idx] = idx
+            yield row
+
+    return (node_header, remap_nodes()), (edge_header, remap_edges())
+
+
+def get_data(
+        data: str = None,
+        **kwargs,
+):
+    """Get (header, rows) pairs for nodes and edges."""
+    if data is not None:
+        nodes, edges = get_data_from_string(data)
         for node in nodes:
-            node["id"] = node_map.get(node["id"], node["id"])
-        for edge in edges:
-            edge["subject"] = node_map.get(edge["subject"], edge["subject"])
-            edge["object"] = node_map.get(edge["object"], edge["object"])
-    return nodes, edges
+            node["category"] = encode_list(node["category"])
+        return to_table(nodes), to_table(edges)
+    return get_data_from_files(**kwargs)
+
+
+def index_statements(table, header, existing=()):
+    """Generate (sql, parameters) pairs that index table.
+
+    Indexes named in existing are skipped.
+    """
+    for index, columns in INDEXES[table]:
+        if index in existing or not set(columns).issubset(header):
+            continue
+        yield "CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(
+            index,
+            table,
+            ", ".join(columns),
+        ), []
+
+
+def load_statements(nodes, edges, begin=True):
+    """Generate (sql, parameters) pairs that load nodes and edges.
+
+    Unless begin is False (i.e. a transaction is already open), the load
+    opens its own transaction, for the caller to commit.
+    """
+    if begin:
+        # bulk-load settings: one transaction means one fsync per load
+        # instead of one per implicit transaction; they cannot change
+        # inside a transaction
+        for pragma in BULK_LOAD_PRAGMAS:
+            yield pragma, []
+        yield "BEGIN", []
+
+    for table, (header, rows) in (("nodes", nodes), ("edges", edges)):
+        if not header:
+            continue
+        yield "CREATE TABLE IF NOT EXISTS {0} ({1})".format(
+            table,
+            ", ".join([f"{val} text" for val in header]),
+        ), []
+        # one multi-row INSERT per batch, as many rows as the
+        # host-parameter limit allows
+        placeholders = "({0})".format(", ".join(["?" for _ in header]))
+        batch_size = min(BATCH_SIZE, max(1, MAX_VARIABLES // len(header)))
+        # batches all go into the one transaction opened above
+        for batch in batched(rows, batch_size):
+            # a short row next to a long one would otherwise shift values
+            # across columns, with the right number of them in total
+            parameters = []
+            for row in batch:
+                if len(row) != len(header):
+                    raise ValueError(
+                        "{0} row has {1} values, not {2}: {3}".format(
+                            table,
+                            len(row),
+                            len(header),
+                            list(row),
+                        )
+                    )
+                parameters.extend(row)
+            yield "INSERT INTO {0} VALUES {1}".format(
+                table,
+                ", ".join([placeholders for _ in batch]),
+            ), parameters
+
+        yield from index_statements(table, header)
+
+
+def table_columns(connection: sqlite3.Connection, table):
+    """Get column names of table, or none if there is no such table."""
+    cursor = connection.cursor()
+    cursor.row_factory = None
+    return [
+        row[1]
+        for row in cursor.execute(f"PRAGMA table_info({table})")
+    ]
+
+
+def build_operations(connection: sqlite3.Connection):
+    """Rebuild operations table from the nodes and edges in the database.
+
+    Does nothing until the database has both.
+    """
+    if not (
+            {"id", "category"}.issubset(table_columns(connection, "nodes"))
+            and {"source", "predicate", "target"}.issubset(
+                table_columns(connection, "edges")
+            )
+    ):
+        return
+    connection.execute("DROP TABLE IF EXISTS operations")
+    connection.execute(BUILD_OPERATIONS)
+
+
+def add_data_sync(
+        connection: sqlite3.Connection,
+        data: str = None,
+        **kwargs,
+):
+    """Add data to SQLite database, synchronously.
+
+    Within an open transaction, the data is added to it, uncommitted.
+    """
+    in_transaction = connection.in_transaction
+    try:
+        for sql, parameters in load_statements(
+                *get_data(data, **kwargs),
+                begin=not in_transaction,
+        ):
+            connection.execute(sql, parameters)
+        # operations are static for a given database, so build them once
+        # per load, from everything loaded so far; upgrading an older
+        # database builds them too
+        if not upgrade_format(connection):
+            build_operations(connection)
+        connection.execute("ANALYZE")
+        if not in_transaction:
+            connection.commit()
+    except BaseException:
+        # otherwise the next load would join our half-done transaction
+        if not in_transaction:
+            connection.rollback()
+        raise
 
 
 async def add_data(
@@ -136,29 +439,108 @@ async def add_data(
         data: str = None,
         **kwargs,
 ):
-    """Add data to SQLite database."""
-    if data is not None:
-        nodes, edges = await get_data_from_string(data)
-    else:
-        nodes, edges = await get_data_from_files(**kwargs)
+    """Add data to SQLite database.
 
-    if nodes:
-        # Convert category list to our custom string format
-        for node in nodes:
-            if "category" in node:
-                node["category"] = "".join(f"|{c}|" for c in node["category"])
-
-        await connection.execute("CREATE TABLE IF NOT EXISTS nodes ({0})".format(
-            ", ".join([f"{val} text" for val in nodes[0]])
-        ))
-        await connection.executemany("INSERT INTO nodes VALUES ({0})".format(
-            ", ".join(["?" for _ in nodes[0]])
-        ), [list(node.values()) for node in nodes])
-    if edges:
-        await connection.execute("CREATE TABLE IF NOT EXISTS edges ({0})".format(
-            ", ".join([f"{val} text" for val in edges[0]])
-        ))
-        await connection.executemany("INSERT INTO edges VALUES ({0})".format(
-            ", ".join(["?" for _ in edges[0]])
-        ), [list(edge.values()) for edge in edges])
-    await connection.commit()
+    Within an open transaction, the data is added to it, uncommitted.
+    """
+    # load on the connection's own thread in one call, rather than one
+    # thread round trip per statement
+    await connection._execute(
+        add_data_sync,
+        connection._conn,
+        data,
+        **kwargs,
+    )
+
+
+def format_version(connection: sqlite3.Connection):
+    """Get format version of database."""
+    cursor = connection.cursor()
+    cursor.row_factory = None
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+
+def decode_old_categories(value):
+    """Convert node categories from format 0 to a JSON array."""
+    if value is None:
+        return None
+    return encode_list(OLD_CATEGORY_PATTERN.findall(value))
+
+
+def upgrade_format(connection: sqlite3.Connection):
+    """Upgrade database in an older format, in place.
+
+    Node categories stored as "|a||b|" are re-encoded as JSON arrays, and
+    the operations table is built. Returns whether anything changed; the
+    changes are left for the caller to commit.
+    """
+    if format_version(connection) >= FORMAT_VERSION:
+        return False
+    if "category" in table_columns(connection, "nodes"):
+        # one pass over the nodes; rows loaded by versions that already
+        # wrote JSON but no format version are left as they are
+        connection.create_function(
+            "decode_old_categories",
+            1,
+            decode_old_categories,
+        )
+        connection.execute(
+            "UPDATE nodes SET category = decode_old_categories(category) "
+            "WHERE category NOT LIKE '[%'",
+        )
+    build_operations(connection)
+    connection.execute(f"PRAGMA user_version={FORMAT_VERSION}")
+    return True
+
+
+async def upgrade(connection: aiosqlite.Connection):
+    """Upgrade database built by an older version, and add any indexes.
+
+    An up-to-date database is only read: statistics are refreshed, and
+    changes committed, only if something changed.
+    """
+    upgraded = await connection._execute(upgrade_format, connection._conn)
+    indexed = await add_indexes(connection)
+    if upgraded or indexed:
+        await connection.execute("ANALYZE")
+        await connection.commit()
+
+
+async def check_format(connection: aiosqlite.Connection):
+    """Raise RuntimeError if database must be upgraded to be served."""
+    version = await connection._execute(format_version, connection._conn)
+    if version < FORMAT_VERSION:
+        raise RuntimeError(
+            "Database was built by an older version of simple-kp (format "
+            "{0}, not {1}). Make it writable, so that it is upgraded at "
+            "startup, or rebuild it with build_db.py.".format(
+                version,
+                FORMAT_VERSION,
+            )
+        )
+
+
+async def add_indexes(connection: aiosqlite.Connection):
+    """Add any missing indexes to an existing database.
+
+    Returns whether any were added; they are left for the caller to
+    commit.
+    """
+    existing = {
+        row[0]
+        for row in await connection.execute_fetchall(
+            "SELECT name FROM sqlite_master WHERE type = 'index'",
+        )
+    }
+    added = False
+    for table in INDEXES:
+        header = [
+            row[1]
+            for row in await connection.execute_fetchall(
+                f"PRAGMA table_info({table})",
+            )
+        ]
+        for sql, parameters in index_statements(table, header, existing):
+            await connection.execute(sql, parameters)
+            added = True
+    return added
@@ -1,17 +1,40 @@
 """SQL query graph engine."""
+import asyncio
 from collections import defaultdict
-import itertools
+import functools
+import json
 import logging
-import os
-import re
-import sqlite3
-from typing import Any, Dict, Tuple, Union
+from pathlib import Path
+import sys
+from typing import Any, Dict, List, Tuple, Union
 
 import aiosqlite
 
-from .util import is_cyclic, to_list, validate_edge, validate_node, NoAnswersException
+from .util import (
+    MAX_VARIABLES, compare_value, get_traversal, is_cyclic, make_edge_template,
+    make_node_template, matches_template, to_list,
+    NoAnswersException,
+)
 
 LOGGER = logging.getLogger(__name__)
+# traces every statement run on pooled connections, at DEBUG level
+SQL_LOGGER = logging.getLogger(__name__ + ".sql")
+
+# memory-map up to 1 GiB of the database file, where there is address space
+# for it
+MMAP_SIZE = 2 ** 30 if sys.maxsize > 2 ** 32 else 2 ** 28
+QUERY_PRAGMAS = [
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-65536",
+    f"PRAGMA mmap_size={MMAP_SIZE}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA query_only=1",
+    "PRAGMA read_uncommitted=1",
+]
+# prepared statements kept per connection, by SQL
+STATEMENT_CACHE_SIZE = 256
+# rows fetched per trip to aiosqlite's thread, when streaming large results
+FETCH_SIZE = 1024
 
 
 def normalize_qgraph(qgraph):
@@ -23,27 +46,97 @@ def normalize_qgraph(qgraph):
             edge.get("predicate", "biolink:related_to"))
 
 
-def to_kedge(row):
-    """Convert operation to kedge."""
-    row.pop("id")
-    if row["predicate"].startswith("<"):
-        kedge = {
-            "subject": row.pop("target"),
-            "predicate": row.pop("predicate")[2:-1],
-            "object": row.pop("source"),
-        }
-    else:
-        kedge = {
-            "subject": row.pop("source"),
-            "predicate": row.pop("predicate")[1:-2],
-            "object": row.pop("target"),
+def encode_predicates(qedge, qnode_id):
+    """Get stored predicates for traversing qedge away from qnode.
+
+    Returns None if the qnode is not an endpoint of the qedge.
+    """
+    if qnode_id == qedge["subject"]:
+        return [
+            f"-{predicate}->"
+            for predicate in qedge["predicate"]
+        ]
+    if qnode_id == qedge["object"]:
+        return [
+            f"<-{predicate}-"
+            for predicate in qedge["predicate"]
+        ]
+    return None
+
+
+def to_kedge(source, predicate, target):
+    """Convert stored edge to kedge."""
+    if predicate[0] == "<":
+        return {
+            "subject": target,
+            "predicate": predicate[2:-1],
+            "object": source,
         }
-    kedge.update(row)
-    return kedge
+    return {
+        "subject": source,
+        "predicate": predicate[1:-2],
+        "object": target,
+    }
+
+
+# the counts come from requests, so keep as many statements as there are
+# prepared statements per connection
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def kedges_sql(num_sources, num_predicates, num_categories):
+    """Get SQL selecting kedges and their target knodes.
+
+    Parameters are the sources, then the predicates, then the categories
+    that the knodes must all have.
+    """
+    return (
+        "SELECT edges.id AS _kedge_id, edges.source AS _source, "
+        "edges.predicate AS _predicate, nodes.* "
+        "FROM edges JOIN nodes ON nodes.id = edges.target "
+        "WHERE edges.source IN ({0}) AND edges.predicate IN ({1}){2}".format(
+            ", ".join("?" for _ in range(num_sources)),
+            ", ".join("?" for _ in range(num_predicates)),
+            # let SQLite drop knodes without the categories, as
+            # validate_node() would, before the rows are built
+            "".join(
+                " AND EXISTS (SELECT 1 FROM json_each(nodes.category) "
+                "WHERE json_each.value = ?)"
+                for _ in range(num_categories)
+            ),
+        )
+    )
+
+
+def get_binding(partial_result, depth):
+    """Get knode id bound `depth` entries down a stack of bindings.
+
+    Each entry is a (knode id, kedge id, rest of stack) triple, with the
+    kedge id being that of the qedge traversed to reach the knode. Stacks
+    share their tails, so extending one does not copy it.
+    """
+    for _ in range(depth):
+        partial_result = partial_result[2]
+    return partial_result[0]
 
 
 list_fields = ['category']
-match_list = re.compile(r"\|(.*?)\|")
+
+
+# (cursor.description, column names) for the most recent statement; the
+# description object is the same for every row a statement returns, so an
+# identity check avoids hashing it per row. The pair is swapped in one
+# assignment, as rows are built on the connections' threads
+_column_names = (None, [])
+
+
+def column_names(cursor):
+    """Get column names from cursor, reusing them across rows."""
+    global _column_names
+    description, names = _column_names
+    if description is not cursor.description:
+        description = cursor.description
+        names = [col[0] for col in description]
+        _column_names = (description, names)
+    return names
 
 
 def custom_row_factory(cursor, row):
@@ -51,18 +144,31 @@ def custom_row_factory(cursor, row):
     Convert row to dictionary and
     convert some of the fields to lists
     """
-    row_output = {}
-    for idx, col in enumerate(cursor.description):
-        row_output[col[0]] = row[idx]
+    row_output = dict(zip(column_names(cursor), row))
 
     for field in list_fields:
         if field not in row_output:
             continue
-        values = match_list.finditer(row_output[field])
-        row_output[field] = [v.group(1) for v in values]
+        value = row_output[field]
+        row_output[field] = json.loads(value) if value else []
     return row_output
 
 
+async def connect(database_file: str) -> aiosqlite.Connection:
+    """Open read-only connection to database file."""
+    # queries never write: open read-only, sharing the page cache
+    # between connections
+    connection = await aiosqlite.connect(
+        Path(database_file).absolute().as_uri() + "?mode=ro&cache=shared",
+        uri=True,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    await connection.executescript(";\n".join(QUERY_PRAGMAS))
+    if SQL_LOGGER.isEnabledFor(logging.DEBUG):
+        await connection.set_trace_callback(SQL_LOGGER.debug)
+    return connection
+
+
 class KnowledgeProvider():
     """Knowledge provider."""
 
@@ -73,9 +179,7 @@ class KnowledgeProvider():
         """Initialize."""
         if isinstance(arg, str):
             self.database_file = arg
-            self.name = os.path.splitext(
-                os.path.basename(self.database_file)
-            )[0]
+            self.name = Path(self.database_file).stem
             self.db = None
         elif isinstance(arg, aiosqlite.Connection):
             self.database_file = None
@@ -91,8 +195,8 @@ class KnowledgeProvider():
         """Enter context."""
         if self.db is not None:
             return self
-        self.db = await aiosqlite.connect(self.database_file)
-        self.db.row_factory = sqlite3.Row
+        self.db = await connect(self.database_file)
+        self.db.row_factory = custom_row_factory
         return self
 
     async def __aexit__(self, *args):
@@ -105,268 +209,133 @@ class KnowledgeProvider():
 
     async def get_operations(self):
         """Get operations."""
-        async with self.db.execute(
-                "SELECT * FROM edges",
-        ) as cursor:
-            edges = await cursor.fetchall()
-
-        async with self.db.execute(
-                "SELECT * FROM nodes",
-        ) as cursor:
-            nodes = await cursor.fetchall()
-        nodes = {
-            node["id"]: node
-            for node in nodes
-        }
-
-        ops = set()
-        for edge in edges:
-            source_node = nodes[edge["source"]]
-            target_node = nodes[edge["target"]]
-
-            operation_iterator = itertools.product(
-                source_node["category"],
-                [edge["predicate"]],
-                target_node["category"],
-            )
-
-            ops.update(operation_iterator)
-
-        return [
-            {
-                "source_type": op[0],
-                "edge_type": op[1],
-                "target_type": op[2],
-            }
-            for op in ops
-        ]
+        return list(await self.db.execute_fetchall(
+            "SELECT source_type, edge_type, target_type FROM operations",
+        ))
 
     async def get_curie_prefixes(self):
         """Get CURIE prefixes."""
+        prefixes = defaultdict(set)
         async with self.db.execute(
-                "SELECT * FROM nodes",
+                "SELECT id, category FROM nodes",
         ) as cursor:
-            nodes = await cursor.fetchall()
-
-        prefixes = defaultdict(set)
-        for node in nodes:
-            for category in node["category"]:
-                prefixes[category].add(node["id"].split(":")[0])
+            cursor.iter_chunk_size = FETCH_SIZE
+            async for node in cursor:
+                for category in node["category"]:
+                    prefixes[category].add(node["id"].split(":")[0])
         return {
             category: list(prefix_set)
             for category, prefix_set in prefixes.items()
         }
 
-    async def get_kedges(self, **kwargs):
-        """Get kedges by source id."""
-        assert kwargs
-        conditions = []
-        for key, value in kwargs.items():
-            if isinstance(value, list):
-                placeholders = ", ".join("?" for _ in value)
-                conditions.append(f"{key} in ({placeholders})")
-            else:
-                conditions.append(f"{key} = ?")
-        conditions = " AND ".join(conditions)
-        async with self.db.execute(
-                "SELECT id, source, predicate, target FROM edges WHERE " + conditions,
-                list(
-                    x for value in kwargs.values()
-                    for x in to_list(value)
-                ),
-        ) as cursor:
-            rows = await cursor.fetchall()
-
-        return {
-            row["id"]: to_kedge(dict(row))
-            for row in rows
-        }
-
-    async def expand_from_node(
+    async def get_kedges(
             self,
-            qgraph: Dict[str, Any],
-            qnode_id: str,
-            knode_id: str,
-            knode: Dict[str, Any],
-    ):
-        """Expand from query graph node."""
-        # if this is a leaf node, we're done
-        if not qgraph["edges"]:
-            return {
-                "nodes": {
-                    knode_id: knode
-                },
-                "edges": dict(),
-            }, [{
-                "node_bindings": {
-                    qnode_id: [{
-                        "id": knode_id,
-                    }],
-                },
-                "edge_bindings": dict(),
-            }]
-
-        LOGGER.debug(
-            "Expanding from node %s/%s...",
-            qnode_id,
-            knode_id,
-        )
+            sources: List[str],
+            predicates: List[str],
+            categories: List[str] = (),
+            cache: Dict = None,
+    ) -> Dict[str, Dict[str, Tuple[Dict, str, Dict]]]:
+        """Get kedges leaving sources, with the knodes they lead to.
+
+        Only knodes having all of the given categories are included.
+        Returns {source id: {kedge id: (kedge, knode id, knode)}}.
+        Lookups already in cache, keyed by (source id, (predicates,
+        categories)), are not repeated, and new ones are added to it.
+        """
+        if cache is None:
+            cache = dict()
+        key = (tuple(predicates), tuple(categories))
+        missing = [
+            source for source in sources
+            if (source, key) not in cache
+        ]
 
-        kgraph = {"nodes": dict(), "edges": dict()}
-        results = []
-        for qedge_id, qedge in qgraph["edges"].items():
-            # get kedges for qedge
-            if qnode_id == qedge["subject"]:
-                kedges = await self.get_kedges(
-                    source=knode_id,
-                    predicate=[
-                        f"-{predicate}->"
-                        for predicate in qedge["predicate"]
-                    ],
-                )
-            elif qnode_id == qedge["object"]:
-                kedges = await self.get_kedges(
-                    source=knode_id,
-                    predicate=[
-                        f"<-{predicate}-"
-                        for predicate in qedge["predicate"]
-                    ],
-                )
-            else:
-                continue
-
-            for kedge_id, kedge in kedges.items():
-                # validate kedge against qedge
-                if not validate_edge(qedge, kedge):
-                    LOGGER.debug(
-                        "kedge %s does not satisfy qedge %s",
-                        str(kedge),
-                        str(qedge),
-                    )
+        kedges = defaultdict(dict)
+
+        async def fetch(chunk):
+            """Add kedges for a chunk of sources."""
+            # pad the chunk to a power-of-two length, so that few distinct
+            # statements are built and sqlite3's statement cache hits
+            num_sources = min(1 << (len(chunk) - 1).bit_length(), chunk_size)
+            chunk = chunk + chunk[-1:] * (num_sources - len(chunk))
+            # the rows become the knodes kept below, so fetching them all
+            # in one round trip holds little beyond what is kept anyway
+            for knode in await self.db.execute_fetchall(
+                    kedges_sql(num_sources, len(predicates), len(categories)),
+                    [*chunk, *predicates, *categories],
+            ):
+                # custom_row_factory() makes a new dict per row, so it can
+                # become the knode as is
+                source = knode.pop("_source")
+                kedge_id = knode.pop("_kedge_id")
+                predicate = knode.pop("_predicate")
+                source_kedges = kedges[source]
+                # with duplicate node rows, keep the first, as get_knode()
+                # does
+                if kedge_id in source_kedges:
                     continue
-
-                # recursively expand from edge
-                kgraph_, results_ = await self.expand_from_edge(
-                    {
-                        "nodes": {
-                            key: value
-                            for key, value in qgraph["nodes"].items()
-                            if key != qnode_id
-                        },
-                        "edges": qgraph["edges"],
-                    },
-                    qedge_id,
-                    kedge_id,
-                    kedge,
+                knode_id = knode.pop("id")
+                source_kedges[kedge_id] = (
+                    to_kedge(source, predicate, knode_id),
+                    knode_id,
+                    knode,
                 )
-                kgraph["nodes"].update(kgraph_["nodes"])
-                kgraph["edges"].update(kgraph_["edges"])
-                results.extend(results_)
 
-        if not results:
-            return kgraph, results
+        # stay under SQLite's host-parameter limit for large frontiers,
+        # queueing all of the chunks at once
+        chunk_size = MAX_VARIABLES - len(predicates) - len(categories)
+        await asyncio.gather(*(
+            fetch(missing[start:start + chunk_size])
+            for start in range(0, len(missing), chunk_size)
+        ))
+        for source in missing:
+            cache[source, key] = kedges.get(source, {})
+        return {
+            source: cache[source, key]
+            for source in sources
+        }
 
-        # add node to results and kgraph
-        kgraph["nodes"][knode_id] = knode
-        results = [
-            {
-                "node_bindings": {
-                    **result["node_bindings"],
-                    qnode_id: [{
-                        "id": knode_id,
-                    }],
-                },
-                "edge_bindings": result["edge_bindings"],
-            }
-            for result in results
-        ]
-        return kgraph, results
+    async def get_knodes(
+            self,
+            knode_ids: List[str],
+            cache: Dict = None,
+    ) -> Dict[str, Tuple[str, Dict]]:
+        """Get knodes by id, in as few queries as possible.
+
+        Returns {knode id: (id, knode)} for the knodes that exist.
+        Knodes already in cache, keyed by id, are not looked up again, and
+        new ones are added to it.
+        """
+        if cache is None:
+            cache = dict()
+        missing = list(dict.fromkeys(
+            knode_id for knode_id in knode_ids
+            if knode_id not in cache
+        ))
+        if missing:
+            # pass the ids as one JSON array, so that the statement is the
+            # same whatever their number
+            for knode in await self.db.execute_fetchall(
+                    "SELECT nodes.* FROM json_each(?) AS ids "
+                    "JOIN nodes ON nodes.id = ids.value",
+                    [json.dumps(missing)],
+            ):
+                knode_id = knode.pop("id")
+                # with duplicate node rows, keep the first
+                if knode_id not in cache:
+                    cache[knode_id] = knode_id, knode
+        return {
+            knode_id: cache[knode_id]
+            for knode_id in knode_ids
+            if knode_id in cache
+        }
 
     async def get_knode(self, knode_id: str) -> Tuple[str, Dict]:
         """Get knode by id."""
-        async with self.db.execute(
-                "SELECT * FROM nodes WHERE id = ?",
-                [knode_id],
-        ) as cursor:
-            row = await cursor.fetchone()
-        if row is None:
+        knodes = await self.get_knodes([knode_id])
+        if knode_id not in knodes:
             raise NoAnswersException()
-        return row["id"], {k: v for k, v in dict(row).items() if k != "id"}
-
-    async def expand_from_edge(
-            self,
-            qgraph: Dict[str, Any],
-            qedge_id: str,
-            kedge_id: str,
-            kedge: Dict[str, Any],
-    ):
-        """Expand along a query graph edge.
-
-        Only one endpoint should be present in the query graph.
-        """
-        LOGGER.debug(
-            "Expanding from edge %s/%s...",
-            qedge_id,
-            kedge_id,
-        )
-        qedge = qgraph["edges"][qedge_id]
-
-        # get the remaining endpoint (query-graph and knowledge-graph nodes)
-        if qedge["object"] in qgraph["nodes"]:
-            qnode_id = qedge["object"]
-            knode_id, knode = await self.get_knode(kedge["object"])
-        elif qedge["subject"] in qgraph["nodes"]:
-            qnode_id = qedge["subject"]
-            knode_id, knode = await self.get_knode(kedge["subject"])
-        else:
-            raise RuntimeError("Expanding from qedge with no endpoints?")
-        qnode = qgraph["nodes"][qnode_id]
-
-        kgraph = {"nodes": dict(), "edges": dict()}
-        results = []
-
-        # validate knode against qnode
-        _knode = {**knode, "id": knode_id}
-        if not validate_node(qnode, _knode):
-            LOGGER.debug(
-                "knode %s does not satisfy qnode %s",
-                str(_knode),
-                str(qnode),
-            )
-            return kgraph, results
-
-        # recursively expand from the endpoint
-        kgraph, results = await self.expand_from_node(
-            {
-                "nodes": qgraph["nodes"],
-                "edges": {
-                    key: value
-                    for key, value in qgraph["edges"].items()
-                    if key != qedge_id
-                },
-            },
-            qnode_id,
-            knode_id,
-            knode,
-        )
-        if not results:
-            return kgraph, results
-
-        # add edge to results and kgraph
-        kgraph["edges"][kedge_id] = kedge
-        results = [
-            {
-                "node_bindings": result["node_bindings"],
-                "edge_bindings": {
-                    **result["edge_bindings"],
-                    qedge_id: [{
-                        "id": kedge_id,
-                    }],
-                },
-            }
-            for result in results
-        ]
-        return kgraph, results
+        return knodes[knode_id]
 
     async def get_results(self, qgraph: Dict[str, Any]):
         """Get results and kgraph."""
@@ -379,25 +348,156 @@ class KnowledgeProvider():
             for key, qnode in qgraph["nodes"].items()
             if qnode.get("id", None) is not None
         )
-        # look up associated knode(s)
-        curies = to_list(qnode["id"])
         kgraph = {
             "nodes": dict(),
             "edges": dict(),
         }
         results = []
-        for curie in curies:
-            try:
-                knode_id, knode = await self.get_knode(curie)
-            except NoAnswersException:
-                break
-            kgraph_, results_ = await self.expand_from_node(
+        # lookup caches, local to this call so that calls sharing the KP
+        # can overlap; see get_knodes() and get_kedges()
+        knode_cache = dict()
+        kedge_cache = dict()
+        # (qedge id, source qnode id, target qnode id, stored predicates)
+        hops = [
+            (
+                qedge_id,
+                source_qnode_id,
+                target_qnode_id,
+                encode_predicates(qgraph["edges"][qedge_id], source_qnode_id),
+            )
+            for qedge_id, source_qnode_id, target_qnode_id in get_traversal(
                 qgraph,
                 qnode_id,
-                knode_id,
-                knode,
             )
-            kgraph["nodes"].update(kgraph_["nodes"])
-            kgraph["edges"].update(kgraph_["edges"])
-            results.extend(results_)
+        ]
+        if len(hops) < len(qgraph["edges"]):
+            # some qedges cannot be reached from the fixed qnode
+            return kgraph, results
+
+        # qnode ids, in the order they are bound
+        qnode_ids = [qnode_id] + [hop[2] for hop in hops]
+        levels = {key: level for level, key in enumerate(qnode_ids)}
+
+        # look up associated knode(s)
+        # each partial result is a stack of bindings, one per qnode bound so
+        # far; see get_binding()
+        partial_results = []
+        # repeated CURIEs would only repeat the same results
+        curies = list(dict.fromkeys(to_list(qnode["id"])))
+        knodes = await self.get_knodes(curies, knode_cache)
+        for curie in curies:
+            if curie not in knodes:
+                break
+            knode_id, knode = knodes[curie]
+            kgraph["nodes"][knode_id] = knode
+            partial_results.append((knode_id, None, None))
+
+        # extend the partial results one qedge at a time, looking up the
+        # kedges for all of them with one query per qedge
+        for level, (
+                qedge_id, source_qnode_id, target_qnode_id, predicates,
+        ) in enumerate(hops):
+            if not partial_results:
+                break
+            qedge = qgraph["edges"][qedge_id]
+            target_qnode = qgraph["nodes"][target_qnode_id]
+            # the target categories are checked in SQL by get_kedges()
+            categories = list(dict.fromkeys(
+                to_list(target_qnode["category"] or [])
+            ))
+            # templates are made once per qedge, not once per candidate;
+            # knodes do not hold their ids, so those are checked apart
+            edge_template = make_edge_template(qedge)
+            node_template = make_node_template({
+                key: value
+                for key, value in target_qnode.items()
+                if key not in ("category", "id")
+            })
+            target_ids = target_qnode.get("id", None)
+            LOGGER.debug(
+                "Expanding from node %s along edge %s...",
+                source_qnode_id,
+                qedge_id,
+            )
+            sources = [
+                get_binding(partial_result, level - levels[source_qnode_id])
+                for partial_result in partial_results
+            ]
+            kedges = await self.get_kedges(
+                list(dict.fromkeys(sources)),
+                predicates,
+                categories,
+                kedge_cache,
+            )
+
+            # validate kedges against qedge and knodes against qnode,
+            # checking once whether rejections are logged
+            debug = LOGGER.isEnabledFor(logging.DEBUG)
+            matches = defaultdict(list)
+            for source, source_kedges in kedges.items():
+                for kedge_id, kedge_knode in source_kedges.items():
+                    kedge, knode_id, knode = kedge_knode
+                    if not matches_template(kedge, edge_template):
+                        if debug:
+                            LOGGER.debug(
+                                "kedge %s does not satisfy qedge %s",
+                                kedge,
+                                qedge,
+                            )
+                        continue
+                    if not (
+                            target_ids is None
+                            or compare_value(knode_id, target_ids)
+                    ) or not matches_template(knode, node_template):
+                        if debug:
+                            LOGGER.debug(
+                                "knode %s %s does not satisfy qnode %s",
+                                knode_id,
+                                knode,
+                                target_qnode,
+                            )
+                        continue
+                    kgraph["nodes"][knode_id] = knode
+                    kgraph["edges"][kedge_id] = kedge
+                    matches[source].append((kedge_id, knode_id))
+
+            # push the new bindings, sharing the rest of each stack
+            partial_results = [
+                (knode_id, kedge_id, partial_result)
+                for partial_result, source in zip(partial_results, sources)
+                for kedge_id, knode_id in matches[source]
+            ]
+
+        # keep only the parts of the kgraph used by some result
+        knode_ids = set()
+        kedge_ids = set()
+        # qedge id traversed to reach each level
+        qedge_ids = [None] + [hop[0] for hop in hops]
+        for partial_result in partial_results:
+            node_bindings = dict()
+            edge_bindings = dict()
+            # fill in the bindings in place, unwinding the stack
+            for level in range(len(hops), -1, -1):
+                knode_id, kedge_id, partial_result = partial_result
+                node_bindings[qnode_ids[level]] = [{"id": knode_id}]
+                knode_ids.add(knode_id)
+                if level:
+                    edge_bindings[qedge_ids[level]] = [{"id": kedge_id}]
+                    kedge_ids.add(kedge_id)
+            results.append({
+                "node_bindings": node_bindings,
+                "edge_bindings": edge_bindings,
+            })
+        kgraph = {
+            "nodes": {
+                key: value
+                for key, value in kgraph["nodes"].items()
+                if key in knode_ids
+            },
+            "edges": {
+                key: value
+                for key, value in kgraph["edges"].items()
+                if key in kedge_ids
+            },
+        }
         return kgraph, results
@@ -0,0 +1,80 @@
+"""SQLite connection pool."""
+import asyncio
+import logging
+
+import aiosqlite
+
+from ._contextlib import asynccontextmanager
+from .engine import connect
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ConnectionPool():
+    """Pool of long-lived read-only connections to a database file.
+
+    Connections are opened on demand, up to `size` of them, and reused
+    across requests so that SQLite's page cache stays warm.
+    """
+
+    def __init__(
+            self,
+            database_file: str,
+            size: int = 4,
+    ):
+        """Initialize."""
+        self.database_file = database_file
+        self.size = size
+        # every connection opened, idle or borrowed
+        self._connections = []
+        # connections being opened, which count towards the size
+        self._opening = 0
+        self._closed = False
+        # created on first use, in the running event loop
+        self._idle = None
+
+    @property
+    def num_connections(self) -> int:
+        """Get number of open connections."""
+        return len(self._connections)
+
+    @asynccontextmanager
+    async def connection(self) -> aiosqlite.Connection:
+        """Borrow connection from the pool."""
+        if self._closed:
+            raise RuntimeError("Connection pool is closed.")
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        if (
+                self._idle.empty()
+                and self.num_connections + self._opening < self.size
+        ):
+            self._opening += 1
+            try:
+                connection = await connect(self.database_file)
+            finally:
+                self._opening -= 1
+            if self._closed:
+                # closed while connecting
+                await connection.close()
+                raise RuntimeError("Connection pool is closed.")
+            self._connections.append(connection)
+            LOGGER.debug(
+                "Opened connection %d to %s",
+                self.num_connections,
+                self.database_file,
+            )
+        else:
+            connection = await self._idle.get()
+        try:
+            yield connection
+        finally:
+            if not self._closed:
+                self._idle.put_nowait(connection)
+
+    async def close(self):
+        """Close all connections, including borrowed ones."""
+        self._closed = True
+        connections, self._connections = self._connections, []
+        for connection in connections:
+            await connection.close()
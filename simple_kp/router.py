@@ -1,18 +1,49 @@
 """FastAPI router."""
 import logging
+from pathlib import Path
+import sqlite3
 from typing import List, Union
 
 import aiosqlite
 from fastapi import Depends, APIRouter
+from fastapi.responses import JSONResponse, ORJSONResponse
+import orjson
 from reasoner_pydantic import Query, Response
 
+from ._contextlib import asynccontextmanager
+from .build_db import check_format, upgrade
 from .engine import KnowledgeProvider
+from .pool import ConnectionPool
 
 LOGGER = logging.getLogger(__name__)
 
 
-def get_kp(database_file: Union[str, aiosqlite.Connection]):
-    """Get KP dependable."""
+class EncodedJSONResponse(JSONResponse):
+    """JSON response with content that is already encoded."""
+
+    def render(self, content: bytes) -> bytes:
+        """Render content."""
+        return content
+
+
+def get_kp(
+        database_file: Union[str, aiosqlite.Connection],
+        pool: ConnectionPool = None,
+):
+    """Get KP dependable.
+
+    Given a pool, connections to the database file are borrowed from it
+    instead of opened for each request.
+    """
+    if pool is not None:
+        async def kp_dependable():
+            """Get knowledge provider."""
+            # KPs keep no state of their own, so one per request costs
+            # nothing
+            async with pool.connection() as connection:
+                yield KnowledgeProvider(connection)
+        return kp_dependable
+
     async def kp_dependable():
         """Get knowledge provider."""
         async with KnowledgeProvider(database_file) as kp:
@@ -20,20 +51,60 @@ def get_kp(database_file: Union[str, aiosqlite.Connection]):
     return kp_dependable
 
 
+async def migrate(database_file: str):
+    """Upgrade database file, if built by an older version, and index it.
+
+    Failing that (e.g. the file is read-only), a database in the current
+    format is still served, only slower without indexes; check_format()
+    stops one in an older format. A missing file is not created.
+    """
+    try:
+        async with aiosqlite.connect(
+                Path(database_file).absolute().as_uri() + "?mode=rw",
+                uri=True,
+        ) as connection:
+            await upgrade(connection)
+    except sqlite3.Error as err:
+        LOGGER.warning("Failed to upgrade %s: %s", database_file, err)
+
+
 def kp_router(
         database_file: Union[str, aiosqlite.Connection],
 ):
     """Add KP to server."""
     router = APIRouter()
+    pool = None
+    if isinstance(database_file, str):
+        pool = ConnectionPool(database_file)
 
-    @router.post("/query", response_model=Response)
+        async def startup():
+            """Prepare database file and open the first connection."""
+            await migrate(database_file)
+            try:
+                async with pool.connection() as connection:
+                    await check_format(connection)
+            except BaseException:
+                # shutdown does not run when startup fails
+                await pool.close()
+                raise
+        router.add_event_handler("startup", startup)
+        router.add_event_handler("shutdown", pool.close)
+    kp_dependable = get_kp(database_file, pool)
+
+    # the response model only documents /query; responses are returned as
+    # ORJSONResponses, which FastAPI neither validates nor re-encodes
+    @router.post(
+        "/query",
+        responses={200: {"model": Response}},
+        response_class=ORJSONResponse,
+    )
     async def answer_question(
             query: Query,
-            kp: KnowledgeProvider = Depends(get_kp(database_file))
-    ) -> Response:
+            kp: KnowledgeProvider = Depends(kp_dependable)
+    ) -> ORJSONResponse:
         """Get results for query graph."""
-        query = query.dict()
-        qgraph = query["message"]["query_graph"]
+        # only the query graph is used, so only it is converted to dicts
+        qgraph = query.message.query_graph.dict()
 
         kgraph, results = await kp.get_results(qgraph)
 
@@ -44,22 +115,41 @@ def kp_router(
                 "query_graph": qgraph,
             }
         }
-        return response
+        return ORJSONResponse(response)
+
+    # a database file does not change while it is served, so its operations
+    # and metadata are encoded once; a caller's connection might gain data,
+    # so its responses are encoded per request
+    static = isinstance(database_file, str)
+    encoded = dict()
+    kp_context = asynccontextmanager(kp_dependable)
+
+    async def get_encoded(key, get):
+        """Get JSON-encoded value from KP."""
+        if key in encoded:
+            return encoded[key]
+        async with kp_context() as kp:
+            content = orjson.dumps(await get(kp))
+        if static:
+            encoded[key] = content
+        return content
 
     @router.get("/ops")
-    async def get_operations(
-            kp: KnowledgeProvider = Depends(get_kp(database_file)),
-    ):
+    async def get_operations():
         """Get KP operations."""
-        return await kp.get_operations()
+        return EncodedJSONResponse(await get_encoded(
+            "ops",
+            lambda kp: kp.get_operations(),
+        ))
 
     @router.get("/metadata")
-    async def get_metadata(
-            kp: KnowledgeProvider = Depends(get_kp(database_file)),
-    ):
+    async def get_metadata():
         """Get metadata."""
-        return {
-            "curie_prefixes": await kp.get_curie_prefixes(),
-        }
+        async def get(kp):
+            """Get metadata from KP."""
+            return {
+                "curie_prefixes": await kp.get_curie_prefixes(),
+            }
+        return EncodedJSONResponse(await get_encoded("metadata", get))
 
     return router
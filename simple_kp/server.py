@@ -8,16 +8,34 @@ from .router import kp_router
 
 LOGGER = logging.getLogger(__name__)
 
-app = FastAPI(
-    title="Test KP",
-    description="Simple dummy KP for testing",
-    version="0.1.0",
-)
-
-database_files = glob.glob("./*.db")
-if not database_files:
-    raise RuntimeError("No database in sqlite/")
-database_file = database_files[0]
-if len(database_files) > 1:
-    LOGGER.warning("More than one database file. Using %s", database_file)
-app.include_router(kp_router(database_file))
+
+def find_database_file() -> str:
+    """Find database file in working directory."""
+    database_files = glob.glob("./*.db")
+    if not database_files:
+        raise RuntimeError("No database in sqlite/")
+    database_file = database_files[0]
+    if len(database_files) > 1:
+        LOGGER.warning("More than one database file. Using %s", database_file)
+    return database_file
+
+
+def create_app(database_file: str = None) -> FastAPI:
+    """Create app serving database file, or the one found."""
+    app = FastAPI(
+        title="Test KP",
+        description="Simple dummy KP for testing",
+        version="0.1.0",
+    )
+    if database_file is None:
+        database_file = find_database_file()
+    app.include_router(kp_router(database_file))
+    return app
+
+
+def __getattr__(name):
+    """Create app on first access (e.g. by uvicorn), not on import."""
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
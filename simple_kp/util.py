@@ -1,10 +1,14 @@
 """Query graph utilities."""
 from collections import defaultdict
+import sqlite3
+
+# SQLITE_MAX_VARIABLE_NUMBER defaults to 32766 since SQLite 3.32.0
+MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
 
 
 def to_list(scalar_or_list):
     """Enclose in list if necessary."""
-    if not isinstance(scalar_or_list, list):
+    if type(scalar_or_list) is not list:
         return [scalar_or_list]
     return scalar_or_list
 
@@ -14,28 +18,82 @@ def is_cyclic(graph):
 
     Assume the graph is connected.
     """
-    visited = {
-        node_id: False
-        for node_id in graph["nodes"]
-    }
-    connections = defaultdict(set)
+    # a connected graph with fewer edges than nodes is a tree
+    if len(graph["edges"]) < len(graph["nodes"]):
+        return False
+    # query graphs are small, so neighbor lists beat sets; parallel edges
+    # are kept once, as before
+    connections = defaultdict(list)
     for edge in graph["edges"].values():
-        connections[edge["subject"]].add(edge["object"])
-        connections[edge["object"]].add(edge["subject"])
-
-    def visit(node):
-        """Visit node and neighbors, recursively."""
-        if visited[node]:
+        subject, object_ = edge["subject"], edge["object"]
+        if object_ in connections[subject]:
+            continue
+        connections[subject].append(object_)
+        if subject != object_:
+            connections[object_].append(subject)
+
+    # depth-first, with a stack of (node, node it was reached from); in an
+    # acyclic graph, each node is reached exactly once
+    visited = set()
+    stack = [(next(iter(graph["nodes"])), None)]
+    while stack:
+        node, parent = stack.pop()
+        if node in visited:
             return True
-        visited[node] = True
-        neighbors = list(connections[node])
-        for node_ in neighbors:
-            connections[node].discard(node_)
-            connections[node_].discard(node)
-            if visit(node_):
-                return True
-        return False
-    return visit(next(iter(graph["nodes"])))
+        visited.add(node)
+        stack.extend(
+            (node_, node)
+            for node_ in connections[node]
+            if node_ != parent
+        )
+    return False
+
+
+def get_traversal(graph, start):
+    """Get breadth-first traversal of (undirected) graph from start node.
+
+    Returns a list of (edge_id, from_node_id, to_node_id) such that every
+    edge starts at a node already reached. Edges that cannot be reached
+    from the start node are omitted.
+    """
+    connections = defaultdict(list)
+    for edge_id, edge in graph["edges"].items():
+        connections[edge["subject"]].append((edge_id, edge["object"]))
+        connections[edge["object"]].append((edge_id, edge["subject"]))
+
+    traversal = []
+    visited = {start}
+    frontier = [start]
+    while frontier:
+        next_frontier = []
+        for node in frontier:
+            for edge_id, node_ in connections[node]:
+                if node_ in visited:
+                    continue
+                visited.add(node_)
+                traversal.append((edge_id, node, node_))
+                next_frontier.append(node_)
+        frontier = next_frontier
+    return traversal
+
+
+def compare_value(object_value, template_value):
+    """Compare object property to template property.
+
+    Some properties might be wrapped in a list. Every value in the
+    template must be present in the object.
+    """
+    # most values are scalars: compare those without wrapping them
+    if type(template_value) is not list:
+        if type(object_value) is not list:
+            return template_value == object_value
+        return template_value in object_value
+    if type(object_value) is not list:
+        object_value = [object_value]
+    for current_value in template_value:
+        if current_value not in object_value:
+            return False
+    return True
 
 
 def compare_template(obj, template):
@@ -48,43 +106,58 @@ def compare_template(obj, template):
     for key, template_value in template.items():
         if key not in obj:
             return False
-        object_value = obj[key]
+        if not compare_value(obj[key], template_value):
+            return False
+
+    return True
+
 
-        # Some properties might be wrapped in a list
-        # Convert all properties to a list for easy comparison
-        object_value_list = to_list(object_value)
-        template_value_list = to_list(template_value)
+def make_node_template(qnode):
+    """Get (key, value) pairs that knodes must match to satisfy qnode."""
+    return tuple(
+        (key, value)
+        for key, value in qnode.items()
+        if key != "is_set" and value is not None
+    )
 
-        # Every value in template_value_list must
-        # be present in object_value_list
-        for current_value in template_value_list:
-            if current_value not in object_value_list:
-                return False
 
+def make_edge_template(qedge):
+    """Get (key, value) pairs that kedges must match to satisfy qedge."""
+    return tuple(
+        (key, value)
+        for key, value in qedge.items()
+        if key not in ("subject", "object") and value is not None
+    )
+
+
+def matches_template(obj, template):
+    """Check object against (key, value) pairs from make_*_template()."""
+    for key, value in template:
+        if key not in obj or not compare_value(obj[key], value):
+            return False
     return True
 
 
+# validate_node() and validate_edge() are public, for other apps; the engine
+# makes templates once per qnode/qedge instead
 def validate_node(qnode, knode):
     """Validate knode against qnode."""
-    template = {
-        key: value
-        for key, value in qnode.items()
-        if key not in ["is_set"] and value is not None
-    }
-    return compare_template(knode, template)
+    for key, value in qnode.items():
+        if key == "is_set" or value is None:
+            continue
+        if key not in knode or not compare_value(knode[key], value):
+            return False
+    return True
 
 
 def validate_edge(qedge, kedge):
     """Validate kedge against qedge."""
-    template = {
-        key: value
-        for key, value in qedge.items()
-        if (
-            key not in ("subject", "object")
-            and value is not None
-        )
-    }
-    return compare_template(kedge, template)
+    for key, value in qedge.items():
+        if key in ("subject", "object") or value is None:
+            continue
+        if key not in kedge or not compare_value(kedge[key], value):
+            return False
+    return True
 
 
 class NoAnswersException(Exception):
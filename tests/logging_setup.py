@@ -36,6 +36,13 @@ def setup_logger():
     """Set up Strider logger."""
     logger = logging.getLogger("simple_kp")
     logger.setLevel(logging.DEBUG)
+    # each test module calls this; add the handler only once, or every
+    # record is emitted once per module
+    if any(
+            isinstance(handler.formatter, ColoredFormatter)
+            for handler in logger.handlers
+    ):
+        return
     handler = logging.StreamHandler()
     handler.setLevel(logging.DEBUG)
     handler.setFormatter(ColoredFormatter())
@@ -0,0 +1,303 @@
+"""Test building and upgrading databases."""
+import sqlite3
+
+import aiosqlite
+import pytest
+
+from simple_kp import build_db
+from simple_kp.build_db import add_data_sync, check_format, upgrade
+from simple_kp.engine import KnowledgeProvider
+from simple_kp.router import migrate
+
+from .logging_setup import setup_logger
+
+setup_logger()
+
+
+def write_csv(path, *lines):
+    """Write lines to CSV file, returning its name."""
+    path.write_text("".join(line + "\n" for line in lines))
+    return str(path)
+
+
+@pytest.fixture
+def nodes_file(tmp_path):
+    """Return nodes CSV file."""
+    return write_csv(
+        tmp_path / "nodes.csv",
+        "id,category",
+        "MESH:1,biolink:ChemicalSubstance",
+        "DOID:1,biolink:Disease",
+        "XX:1,biolink:Disease",
+    )
+
+
+def test_load_files(tmp_path, nodes_file):
+    """Test loading nodes and edges from CSV files."""
+    edges_file = write_csv(
+        tmp_path / "edges.csv",
+        "source,predicate,target",
+        "MESH:1,-biolink:treats->,DOID:1",
+        "MESH:1,-biolink:treats->,XX:1",
+    )
+    connection = sqlite3.connect(":memory:")
+    add_data_sync(connection, nodes_file=nodes_file, edges_file=edges_file)
+    assert connection.execute("SELECT * FROM nodes").fetchall() == [
+        ("MESH:1", '["biolink:ChemicalSubstance"]'),
+        ("DOID:1", '["biolink:Disease"]'),
+        ("XX:1", '["biolink:Disease"]'),
+    ]
+    assert connection.execute("SELECT * FROM edges").fetchall() == [
+        ("MESH:1", "-biolink:treats->", "DOID:1", "0"),
+        ("MESH:1", "-biolink:treats->", "XX:1", "1"),
+    ]
+    assert connection.execute("SELECT * FROM operations").fetchall() == [
+        ("biolink:ChemicalSubstance", "-biolink:treats->", "biolink:Disease"),
+    ]
+
+
+def test_load_edge_ids(tmp_path, nodes_file):
+    """Test that edges are numbered in place of their own ids."""
+    edges_file = write_csv(
+        tmp_path / "edges.csv",
+        "id,source,predicate,target",
+        "a,MESH:1,-biolink:treats->,DOID:1",
+        "b,MESH:1,-biolink:treats->,XX:1",
+    )
+    connection = sqlite3.connect(":memory:")
+    add_data_sync(connection, nodes_file=nodes_file, edges_file=edges_file)
+    assert connection.execute("SELECT * FROM edges").fetchall() == [
+        ("0", "MESH:1", "-biolink:treats->", "DOID:1"),
+        ("1", "MESH:1", "-biolink:treats->", "XX:1"),
+    ]
+
+
+def test_load_blank_lines(tmp_path):
+    """Test that blank lines in CSV files are skipped."""
+    nodes_file = write_csv(
+        tmp_path / "nodes.csv",
+        "id,category",
+        "MESH:1,biolink:ChemicalSubstance",
+        "",
+        "DOID:1,biolink:Disease",
+        "",
+    )
+    edges_file = write_csv(
+        tmp_path / "edges.csv",
+        "source,predicate,target",
+        "MESH:1,-biolink:treats->,DOID:1",
+        "",
+    )
+    connection = sqlite3.connect(":memory:")
+    add_data_sync(connection, nodes_file=nodes_file, edges_file=edges_file)
+    assert connection.execute("SELECT * FROM nodes").fetchall() == [
+        ("MESH:1", '["biolink:ChemicalSubstance"]'),
+        ("DOID:1", '["biolink:Disease"]'),
+    ]
+    assert connection.execute("SELECT * FROM edges").fetchall() == [
+        ("MESH:1", "-biolink:treats->", "DOID:1", "0"),
+    ]
+
+
+def test_load_ragged_rows(tmp_path, nodes_file):
+    """Test that rows without a field for each column are refused."""
+    edges_file = write_csv(
+        tmp_path / "edges.csv",
+        "source,predicate,target",
+        "MESH:1,-biolink:treats->",
+        "MESH:1,-biolink:treats->,XX:1,extra",
+    )
+    connection = sqlite3.connect(":memory:")
+    with pytest.raises(ValueError, match="edges.csv, line 2"):
+        add_data_sync(
+            connection,
+            nodes_file=nodes_file,
+            edges_file=edges_file,
+        )
+
+
+def test_load_ragged_batch():
+    """Test that a batch is refused unless each row fits the header."""
+    statements = build_db.load_statements(
+        (["id", "category"], [
+            ["A:1", '["biolink:Gene"]'],
+            ["A:2", '["biolink:Gene"]', "extra"],
+        ]),
+        ([], []),
+        begin=False,
+    )
+    with pytest.raises(ValueError, match="nodes row has 3 values, not 2"):
+        list(statements)
+
+
+def test_failed_load(tmp_path, nodes_file):
+    """Test that a failed load is rolled back."""
+    edges_file = write_csv(
+        tmp_path / "edges.csv",
+        "source,predicate,target",
+        "MESH:1,-biolink:treats->",
+    )
+    connection = sqlite3.connect(":memory:")
+    with pytest.raises(ValueError):
+        add_data_sync(
+            connection,
+            nodes_file=nodes_file,
+            edges_file=edges_file,
+        )
+    assert not connection.in_transaction
+    assert connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+    ).fetchall() == []
+
+
+def test_load_remapped_files(tmp_path, nodes_file, monkeypatch):
+    """Test loading CSV files, mapping CURIEs to preferred prefixes."""
+    edges_file = write_csv(
+        tmp_path / "edges.csv",
+        "subject,predicate,object",
+        "MESH:1,biolink:treats,DOID:1",
+        "MESH:1,biolink:treats,XX:1",
+    )
+    monkeypatch.setattr(build_db, "synonyms_file", write_csv(
+        tmp_path / "synonyms.csv",
+        "MESH:1,CHEBI:1",
+        "DOID:1,MONDO:1,MONDO:2",
+    ))
+    connection = sqlite3.connect(":memory:")
+    add_data_sync(
+        connection,
+        curie_prefixes={
+            "biolink:ChemicalSubstance": ["CHEBI"],
+            "biolink:Disease": ["MONDO"],
+        },
+        nodes_file=nodes_file,
+        edges_file=edges_file,
+    )
+    # XX:1 has no synonyms, so keeps its id
+    assert connection.execute("SELECT id FROM nodes").fetchall() == [
+        ("CHEBI:1",),
+        ("MONDO:1",),
+        ("XX:1",),
+    ]
+    assert connection.execute("SELECT * FROM edges").fetchall() == [
+        ("CHEBI:1", "biolink:treats", "MONDO:1", "0"),
+        ("CHEBI:1", "biolink:treats", "XX:1", "1"),
+    ]
+
+
+def test_journal_mode(tmp_path):
+    """Test that built database files keep the default journal mode.
+
+    In WAL mode, a file could not be opened in a read-only directory.
+    """
+    database_file = str(tmp_path / "kp.db")
+    connection = sqlite3.connect(database_file)
+    add_data_sync(connection, data="""
+        MONDO:0005148(( category biolink:Disease ))
+    """)
+    connection.close()
+    connection = sqlite3.connect(database_file)
+    assert connection.execute("PRAGMA journal_mode").fetchone() == ("delete",)
+    connection.close()
+
+
+@pytest.fixture(params=[
+    # categories as "|a||b|"
+    ["|biolink:Disease|", "|biolink:ChemicalSubstance||biolink:Drug|"],
+    # categories as JSON, but no format version or operations table
+    ['["biolink:Disease"]', '["biolink:ChemicalSubstance","biolink:Drug"]'],
+])
+def old_database_file(tmp_path, request):
+    """Return database file in the format of older versions."""
+    database_file = str(tmp_path / "old.db")
+    connection = sqlite3.connect(database_file)
+    connection.execute("CREATE TABLE nodes (id text, category text)")
+    connection.executemany(
+        "INSERT INTO nodes VALUES (?, ?)",
+        zip(["MONDO:0005148", "CHEBI:6801"], request.param),
+    )
+    connection.execute(
+        "CREATE TABLE edges "
+        "(id text, source text, predicate text, target text)"
+    )
+    connection.execute("INSERT INTO edges VALUES (?, ?, ?, ?)", [
+        "0", "MONDO:0005148", "<-biolink:treats-", "CHEBI:6801",
+    ])
+    connection.commit()
+    connection.close()
+    return database_file
+
+
+@pytest.mark.asyncio
+async def test_old_format(old_database_file):
+    """Test that databases in the old format are refused."""
+    async with aiosqlite.connect(old_database_file) as connection:
+        with pytest.raises(RuntimeError, match="older version"):
+            await check_format(connection)
+
+
+@pytest.mark.asyncio
+async def test_migrate_missing_file(tmp_path):
+    """Test that a missing database file is not created."""
+    database_file = tmp_path / "missing.db"
+    await migrate(str(database_file))
+    assert not database_file.exists()
+
+
+@pytest.mark.asyncio
+async def test_migrate(old_database_file):
+    """Test upgrading database in the old format."""
+    await migrate(old_database_file)
+    async with aiosqlite.connect(old_database_file) as connection:
+        await check_format(connection)
+
+    async with KnowledgeProvider(old_database_file) as kp:
+        ops = await kp.get_operations()
+        assert len(ops) == 2
+        prefixes = await kp.get_curie_prefixes()
+        assert set(prefixes) == {
+            "biolink:Disease",
+            "biolink:ChemicalSubstance",
+            "biolink:Drug",
+        }
+        kgraph, results = await kp.get_results({
+            "nodes": {
+                "n0": {"category": "biolink:Disease", "id": "MONDO:0005148"},
+                "n1": {"category": "biolink:Drug"},
+            },
+            "edges": {
+                "e01": {
+                    "subject": "n1",
+                    "object": "n0",
+                    "predicate": "biolink:treats",
+                },
+            },
+        })
+        assert len(results) == 1
+        assert kgraph["nodes"]["CHEBI:6801"]["category"] == [
+            "biolink:ChemicalSubstance",
+            "biolink:Drug",
+        ]
+
+
+@pytest.mark.asyncio
+async def test_upgrade_current(tmp_path):
+    """Test that upgrading an up-to-date database does not write to it."""
+    database_file = str(tmp_path / "current.db")
+    connection = sqlite3.connect(database_file)
+    add_data_sync(connection, data="""
+        MONDO:0005148(( category biolink:Disease ))
+        MONDO:0005148<-- predicate biolink:treats --CHEBI:6801
+        CHEBI:6801(( category biolink:ChemicalSubstance ))
+    """)
+    connection.close()
+
+    async with aiosqlite.connect(database_file) as connection:
+        statements = []
+        await connection.set_trace_callback(statements.append)
+        await upgrade(connection)
+    assert all(
+        statement.startswith(("SELECT", "PRAGMA"))
+        for statement in statements
+    ), statements
+    assert statements
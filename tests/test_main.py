@@ -1,9 +1,12 @@
 """Test /query endpoint."""
+import asyncio
+
 import aiosqlite
 import pytest
 
 from reasoner_pydantic import KnowledgeGraph, Result
 
+from simple_kp import engine
 from simple_kp.build_db import add_data
 from simple_kp.engine import KnowledgeProvider
 
@@ -20,40 +23,241 @@ async def connection():
         yield connection
 
 
+DATA = """
+    MONDO:0005148(( category biolink:Disease ))
+    MONDO:0005148<-- predicate biolink:treats --CHEBI:6801
+    CHEBI:6801(( category biolink:ChemicalSubstance ))
+"""
+
+
+def one_hop(n0, n1, predicate="biolink:treats"):
+    """Get one-hop query graph with n1 as subject, n0 as object."""
+    return {
+        "nodes": {
+            "n0": n0,
+            "n1": n1,
+        },
+        "edges": {
+            "e01": {
+                "subject": "n1",
+                "object": "n0",
+                "predicate": predicate,
+            },
+        },
+    }
+
+
+@pytest.mark.parametrize("qgraph,num_results", [
+    pytest.param(
+        one_hop(
+            {"category": "biolink:Disease", "id": "MONDO:0005148"},
+            {"category": "biolink:ChemicalSubstance"},
+        ),
+        1,
+        id="reverse",
+    ),
+    pytest.param(
+        # prohibited object->subject lookup
+        one_hop(
+            {"category": "biolink:Disease"},
+            {"category": "biolink:ChemicalSubstance", "id": "CHEBI:6801"},
+        ),
+        0,
+        id="no_reverse",
+    ),
+    pytest.param(
+        # is-it-true-that query
+        one_hop(
+            {"category": "biolink:Disease", "id": "MONDO:0005148"},
+            {"category": "biolink:ChemicalSubstance", "id": "CHEBI:6801"},
+        ),
+        1,
+        id="isittrue",
+    ),
+    pytest.param(
+        one_hop(
+            {"category": "biolink:Disease", "id": "MONDO:0005148"},
+            {"category": "biolink:ChemicalSubstance"},
+            predicate="biolink:causes",
+        ),
+        0,
+        id="fail",
+    ),
+    pytest.param(
+        # repeated curies do not repeat results
+        one_hop(
+            {
+                "category": "biolink:Disease",
+                "id": ["MONDO:0005148", "MONDO:0005148"],
+            },
+            {"category": "biolink:ChemicalSubstance"},
+        ),
+        1,
+        id="duplicate_ids",
+    ),
+])
 @pytest.mark.asyncio
-async def test_reverse(connection: aiosqlite.Connection):
+async def test_query(connection: aiosqlite.Connection, qgraph, num_results):
     """Test simple KP."""
-    await add_data(
-        connection,
-        data="""
-            MONDO:0005148(( category biolink:Disease ))
-            MONDO:0005148<-- predicate biolink:treats --CHEBI:6801
-            CHEBI:6801(( category biolink:ChemicalSubstance ))
-        """,
-    )
+    await add_data(connection, data=DATA)
     kp = KnowledgeProvider(connection)
-    message = {
-        "query_graph": {
-            "nodes": {
-                "n0": {
-                    "category": "biolink:Disease",
-                    "id": "MONDO:0005148",
-                },
-                "n1": {
-                    "category": "biolink:ChemicalSubstance",
-                },
+    kgraph, results = await kp.get_results(qgraph)
+    assert len(results) == num_results
+
+
+GRAPH_DATA = """
+    A:0(( category biolink:Gene ))
+    B:0(( category biolink:Disease ))
+    B:1(( category biolink:Disease ))
+    C:0(( category biolink:ChemicalSubstance ))
+    C:1(( category biolink:ChemicalSubstance ))
+    D:0(( category biolink:ChemicalSubstance ))
+    A:0-- predicate biolink:related_to -->B:0
+    A:0-- predicate biolink:related_to -->B:1
+    B:0<-- predicate biolink:treats --C:0
+    B:1<-- predicate biolink:treats --C:1
+    A:0-- predicate biolink:interacts_with -->D:0
+"""
+
+
+def get_bindings(results, *qnode_ids):
+    """Get knode ids bound to qnode ids, one tuple per result."""
+    return {
+        tuple(
+            result["node_bindings"][qnode_id][0]["id"]
+            for qnode_id in qnode_ids
+        )
+        for result in results
+    }
+
+
+@pytest.mark.parametrize("edges,bindings", [
+    pytest.param(
+        {
+            "e01": {
+                "subject": "n0",
+                "object": "n1",
+                "predicate": "biolink:related_to",
             },
-            "edges": {
-                "e01": {
-                    "subject": "n1",
-                    "object": "n0",
-                    "predicate": "biolink:treats",
-                },
+            "e21": {
+                "subject": "n2",
+                "object": "n1",
+                "predicate": "biolink:treats",
             },
-        }
+        },
+        {("B:0", "C:0"), ("B:1", "C:1")},
+        id="chain",
+    ),
+    pytest.param(
+        # every n1 goes with every n2
+        {
+            "e01": {
+                "subject": "n0",
+                "object": "n1",
+                "predicate": "biolink:related_to",
+            },
+            "e02": {
+                "subject": "n0",
+                "object": "n2",
+                "predicate": "biolink:interacts_with",
+            },
+        },
+        {("B:0", "D:0"), ("B:1", "D:0")},
+        id="star",
+    ),
+    pytest.param(
+        # e12 cannot be reached from n0
+        {
+            "e12": {
+                "subject": "n2",
+                "object": "n1",
+                "predicate": "biolink:treats",
+            },
+        },
+        set(),
+        id="unreachable",
+    ),
+    pytest.param(
+        # parallel qedges are not traversed
+        {
+            "e01": {
+                "subject": "n0",
+                "object": "n1",
+                "predicate": "biolink:related_to",
+            },
+            "e01_": {
+                "subject": "n0",
+                "object": "n1",
+                "predicate": "biolink:related_to",
+            },
+        },
+        set(),
+        id="parallel",
+    ),
+])
+@pytest.mark.asyncio
+async def test_two_hop(connection: aiosqlite.Connection, edges, bindings):
+    """Test query graphs with two qedges from the fixed qnode."""
+    await add_data(connection, data=GRAPH_DATA)
+    kp = KnowledgeProvider(connection)
+    qgraph = {
+        "nodes": {
+            "n0": {"category": "biolink:Gene", "id": "A:0"},
+            "n1": {"category": "biolink:Disease"},
+            "n2": {"category": "biolink:ChemicalSubstance"},
+        },
+        "edges": edges,
     }
-    kgraph, results = await kp.get_results(message["query_graph"])
-    assert results
+    kgraph, results = await kp.get_results(qgraph)
+    assert get_bindings(results, "n1", "n2") == bindings
+    assert len(results) == len(bindings)
+
+
+@pytest.mark.asyncio
+async def test_large_frontier(connection: aiosqlite.Connection, monkeypatch):
+    """Test expanding from more knodes than fit in one query."""
+    num_knodes = 5
+    await add_data(connection, data="\n".join([
+        "A:0(( category biolink:Gene ))",
+        *(
+            line
+            for idx in range(num_knodes)
+            for line in (
+                f"B:{idx}(( category biolink:Disease ))",
+                f"C:{idx}(( category biolink:ChemicalSubstance ))",
+                f"A:0-- predicate biolink:related_to -->B:{idx}",
+                f"B:{idx}<-- predicate biolink:treats --C:{idx}",
+            )
+        ),
+    ]))
+    # two sources per query: one variable each goes to the predicate and
+    # the category
+    monkeypatch.setattr(engine, "MAX_VARIABLES", 4)
+    kp = KnowledgeProvider(connection)
+    kgraph, results = await kp.get_results({
+        "nodes": {
+            "n0": {"category": "biolink:Gene", "id": "A:0"},
+            "n1": {"category": "biolink:Disease"},
+            "n2": {"category": "biolink:ChemicalSubstance"},
+        },
+        "edges": {
+            "e01": {
+                "subject": "n0",
+                "object": "n1",
+                "predicate": "biolink:related_to",
+            },
+            "e21": {
+                "subject": "n2",
+                "object": "n1",
+                "predicate": "biolink:treats",
+            },
+        },
+    })
+    assert get_bindings(results, "n1", "n2") == {
+        (f"B:{idx}", f"C:{idx}")
+        for idx in range(num_knodes)
+    }
+    assert len(kgraph["edges"]) == 2 * num_knodes
 
 
 @pytest.mark.asyncio
@@ -135,52 +339,23 @@ async def test_multiple_categories(connection: aiosqlite.Connection):
 
 
 @pytest.mark.asyncio
-async def test_no_reverse(connection: aiosqlite.Connection):
-    """Test prohibited object->subject lookup."""
+async def test_batched_loads(connection: aiosqlite.Connection):
+    """Test adding data in several loads, in one transaction."""
+    await connection.execute("BEGIN")
     await add_data(
         connection,
         data="""
             MONDO:0005148(( category biolink:Disease ))
-            MONDO:0005148<-- predicate biolink:treats --CHEBI:6801
             CHEBI:6801(( category biolink:ChemicalSubstance ))
         """,
     )
-    kp = KnowledgeProvider(connection)
-    message = {
-        "query_graph": {
-            "nodes": {
-                "n0": {
-                    "category": "biolink:ChemicalSubstance",
-                    "id": "CHEBI:6801",
-                },
-                "n1": {
-                    "category": "biolink:Disease",
-                },
-            },
-            "edges": {
-                "e01": {
-                    "subject": "n0",
-                    "object": "n1",
-                    "predicate": "biolink:treats",
-                },
-            },
-        }
-    }
-    kgraph, results = await kp.get_results(message["query_graph"])
-    assert results == []
-
-
-@pytest.mark.asyncio
-async def test_isittrue(connection: aiosqlite.Connection):
-    """Test is-it-true-that query."""
     await add_data(
         connection,
         data="""
-            MONDO:0005148(( category biolink:Disease ))
             MONDO:0005148<-- predicate biolink:treats --CHEBI:6801
-            CHEBI:6801(( category biolink:ChemicalSubstance ))
         """,
     )
+    await connection.commit()
     kp = KnowledgeProvider(connection)
     message = {
         "query_graph": {
@@ -191,7 +366,6 @@ async def test_isittrue(connection: aiosqlite.Connection):
                 },
                 "n1": {
                     "category": "biolink:ChemicalSubstance",
-                    "id": "CHEBI:6801",
                 },
             },
             "edges": {
@@ -208,36 +382,74 @@ async def test_isittrue(connection: aiosqlite.Connection):
 
 
 @pytest.mark.asyncio
-async def test_fail(connection: aiosqlite.Connection):
-    """Test simple KP."""
+async def test_overlapping_queries(connection: aiosqlite.Connection):
+    """Test queries overlapping on one KP."""
     await add_data(
         connection,
         data="""
-            MONDO:0005148(( category biolink:Disease ))
-            MONDO:0005148<-- predicate biolink:treats --CHEBI:6801
-            CHEBI:6801(( category biolink:ChemicalSubstance ))
+            A:0(( category biolink:Gene ))
+            A:1(( category biolink:Gene ))
+            B:0(( category biolink:Disease ))
+            B:1(( category biolink:Disease ))
+            C:0(( category biolink:Gene ))
+            A:0-- predicate biolink:related_to -->B:0
+            A:1-- predicate biolink:related_to -->B:1
+            B:0-- predicate biolink:related_to -->C:0
         """,
     )
     kp = KnowledgeProvider(connection)
-    message = {
-        "query_graph": {
-            "nodes": {
-                "n0": {
-                    "category": "biolink:Disease",
-                    "id": "MONDO:0005148",
-                },
-                "n1": {
-                    "category": "biolink:ChemicalSubstance",
-                },
-            },
-            "edges": {
-                "e01": {
-                    "subject": "n1",
-                    "object": "n0",
-                    "predicate": "biolink:causes",
-                },
-            },
-        }
+    two_hop = {
+        "nodes": {
+            "n0": {"id": "A:0", "category": "biolink:Gene"},
+            "n1": {"category": "biolink:Disease"},
+            "n2": {"category": "biolink:Gene"},
+        },
+        "edges": {
+            "e01": {"subject": "n0", "object": "n1"},
+            "e12": {"subject": "n1", "object": "n2"},
+        },
     }
-    kgraph, results = await kp.get_results(message["query_graph"])
-    assert results == []
+    one_hop = {
+        "nodes": {
+            "n0": {"id": ["A:0", "A:1"], "category": "biolink:Gene"},
+            "n1": {"category": "biolink:Disease"},
+        },
+        "edges": {
+            "e01": {"subject": "n0", "object": "n1"},
+        },
+    }
+
+    # the one-hop query starts once the two-hop query has done its first
+    # hop, and the two-hop query finishes while the one-hop query looks up
+    # its edges
+    first_hop_done = asyncio.Event()
+    second_looking_up = asyncio.Event()
+    first_done = asyncio.Event()
+    execute_fetchall = connection.execute_fetchall
+
+    async def interleaved_execute_fetchall(sql, parameters=None):
+        """Execute, pausing at the points above."""
+        if "B:0" in parameters:
+            first_hop_done.set()
+            await second_looking_up.wait()
+        if "A:1" in parameters:
+            second_looking_up.set()
+            await first_done.wait()
+        return await execute_fetchall(sql, parameters)
+    connection.execute_fetchall = interleaved_execute_fetchall
+
+    async def first():
+        """Run two-hop query."""
+        try:
+            return await kp.get_results(two_hop)
+        finally:
+            first_done.set()
+
+    async def second():
+        """Run one-hop query."""
+        await first_hop_done.wait()
+        return await kp.get_results(one_hop)
+
+    (_, results0), (_, results1) = await asyncio.gather(first(), second())
+    assert len(results0) == 1
+    assert len(results1) == 2
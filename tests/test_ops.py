@@ -21,6 +21,8 @@ async def connection():
 @pytest.mark.asyncio
 async def test_ops(connection: aiosqlite.Connection):
     """Test KP operations."""
+    # load both into one transaction, checking operations in between
+    await connection.execute("BEGIN")
     await add_data(
         connection,
         data="""
@@ -44,6 +46,7 @@ async def test_ops(connection: aiosqlite.Connection):
     kp = KnowledgeProvider(connection)
     ops = await kp.get_operations()
     assert len(ops) == 2
+    await connection.commit()
 
 
 @pytest.mark.asyncio
@@ -64,6 +67,40 @@ async def test_ops_multiple_categories(connection: aiosqlite.Connection):
     assert len(ops) == 4
 
 
+@pytest.mark.asyncio
+async def test_ops_separate_loads(connection: aiosqlite.Connection):
+    """Test KP operations with nodes and edges loaded apart."""
+    await add_data(
+        connection,
+        data="""
+        MONDO:0005148(( category biolink:Disease ))
+        CHEBI:6801(( category biolink:ChemicalSubstance ))
+        """,
+    )
+    await add_data(
+        connection,
+        data="""
+        MONDO:0005148<-- predicate biolink:treats --CHEBI:6801
+        """,
+    )
+    kp = KnowledgeProvider(connection)
+    ops = await kp.get_operations()
+    assert len(ops) == 1
+
+    # operations are kept up to date by later loads of nodes only
+    await add_data(
+        connection,
+        data="""
+        CHEBI:6801(( category biolink:Drug ))
+        """,
+    )
+    ops = await kp.get_operations()
+    assert {op["target_type"] for op in ops} == {
+        "biolink:ChemicalSubstance",
+        "biolink:Drug",
+    }
+
+
 @pytest.mark.asyncio
 async def test_prefixes(connection: aiosqlite.Connection):
     """Test CURIE prefixes."""
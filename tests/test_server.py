@@ -0,0 +1,125 @@
+"""Test serving database file."""
+import asyncio
+import sqlite3
+
+import httpx
+import pytest
+from starlette.testclient import TestClient
+
+from simple_kp import router
+from simple_kp.build_db import add_data_sync
+from simple_kp.pool import ConnectionPool
+from simple_kp.server import create_app
+
+from .logging_setup import setup_logger
+
+setup_logger()
+
+QUERY = {
+    "message": {
+        "query_graph": {
+            "nodes": {
+                "n0": {"category": "biolink:Disease", "id": "MONDO:0005148"},
+                "n1": {"category": "biolink:ChemicalSubstance"},
+            },
+            "edges": {
+                "e01": {
+                    "subject": "n1",
+                    "object": "n0",
+                    "predicate": "biolink:treats",
+                },
+            },
+        },
+    },
+}
+
+
+@pytest.fixture
+def database_file(tmp_path):
+    """Return database file."""
+    database_file = str(tmp_path / "kp.db")
+    connection = sqlite3.connect(database_file)
+    add_data_sync(connection, data="""
+        MONDO:0005148(( category biolink:Disease ))
+        MONDO:0005148<-- predicate biolink:treats --CHEBI:6801
+        CHEBI:6801(( category biolink:ChemicalSubstance ))
+    """)
+    connection.close()
+    return database_file
+
+
+@pytest.fixture
+def pools(monkeypatch):
+    """Return list of the connection pools made, each of size 2."""
+    pools = []
+
+    class SmallConnectionPool(ConnectionPool):
+        """Connection pool of size 2, recorded in pools."""
+
+        def __init__(self, database_file):
+            """Initialize."""
+            super().__init__(database_file, size=2)
+            pools.append(self)
+
+    monkeypatch.setattr(router, "ConnectionPool", SmallConnectionPool)
+    return pools
+
+
+def test_serve_file(database_file, pools, event_loop):
+    """Test serving database file."""
+    app = create_app(database_file)
+    with TestClient(app) as client:
+        response = client.post("/query", json=QUERY)
+        response.raise_for_status()
+        assert len(response.json()["message"]["results"]) == 1
+
+        # operations and metadata are encoded once, then reused
+        for _ in range(2):
+            response = client.get("/ops")
+            response.raise_for_status()
+            assert response.json() == [{
+                "source_type": "biolink:Disease",
+                "edge_type": "<-biolink:treats-",
+                "target_type": "biolink:ChemicalSubstance",
+            }]
+            response = client.get("/metadata")
+            response.raise_for_status()
+            assert response.json() == {"curie_prefixes": {
+                "biolink:Disease": ["MONDO"],
+                "biolink:ChemicalSubstance": ["CHEBI"],
+            }}
+
+        # more requests at once than the pool has connections; the test
+        # client runs the app in this event loop
+        async def query_all():
+            """Send queries at once."""
+            async with httpx.AsyncClient(
+                    app=app,
+                    base_url="http://kp",
+            ) as async_client:
+                return await asyncio.gather(*(
+                    async_client.post("/query", json=QUERY)
+                    for _ in range(10)
+                ))
+        for response in event_loop.run_until_complete(query_all()):
+            response.raise_for_status()
+            assert len(response.json()["message"]["results"]) == 1
+        pool, = pools
+        assert pool.num_connections == pool.size
+
+    # shutdown closes the pool's connections
+    assert pool.num_connections == 0
+
+
+@pytest.mark.asyncio
+async def test_close_pool(database_file):
+    """Test that closing a pool closes borrowed connections too."""
+    pool = ConnectionPool(database_file)
+    async with pool.connection():
+        async with pool.connection():
+            pass
+        await pool.close()
+        assert pool.num_connections == 0
+    with pytest.raises(RuntimeError, match="closed"):
+        async with pool.connection():
+            pass